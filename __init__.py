@@ -4,4 +4,4 @@
 version = "1.0.0"
  
 # Define __all__ to control which modules are exposed
-__all__ = ["media_repository", "config_engine"]
\ No newline at end of file
+__all__ = ["media_repository", "config_engine", "thermal_engine", "duplicate_engine", "sync_engine", "log_engine", "effect_engine", "cache_engine"]
\ No newline at end of file
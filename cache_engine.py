@@ -0,0 +1,294 @@
+import json
+import os
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from tqdm import tqdm
+
+from media_repository import render_rendition, file_checksum, get_content_size
+
+CHECKPOINT_FILENAME = '.rerender.json'
+
+# Resolution and JPEG quality a cache was rendered with
+PARAMS_FILENAME = '.params.json'
+
+# Left over by caches created, or swapped, before caches were versioned
+LEGACY_SUFFIXES = ['.legacy', '.old']
+
+def list_cache_versions(cache_path):
+    """Return the versioned directories `<cache>.v<N>` of a cache, oldest first."""
+    parent = os.path.dirname(cache_path)
+    pattern = re.compile(re.escape(os.path.basename(cache_path)) + r'\.v(\d+)$')
+
+    versions = []
+    for name in os.listdir(parent or '.'):
+        match = pattern.match(name)
+        if match and os.path.isdir(os.path.join(parent, name)):
+            versions.append((int(match.group(1)), os.path.join(parent, name)))
+
+    return [path for _, path in sorted(versions)]
+
+def cache_params(size, quality):
+    return {'width': size[0], 'height': size[1], 'quality': quality}
+
+def read_cache_params(cache_path):
+    """Return the parameters a cache was rendered with, None if unknown, e.g. created before they were recorded."""
+    params_path = os.path.join(cache_path, PARAMS_FILENAME)
+    if not os.path.isfile(params_path):
+        return None
+
+    with open(params_path, 'r') as file:
+        return json.load(file)
+
+def create_cache(cache_path, size, quality):
+    """Create an empty cache. The renditions ingested into it are rendered with `quality`."""
+    os.makedirs(cache_path)
+    with open(os.path.join(cache_path, PARAMS_FILENAME), 'w') as file:
+        json.dump(cache_params(size, quality), file, indent=4)
+
+def point_cache_to(cache_path, version_path):
+    """Atomically replace the `cache_path` symlink by one pointing to `version_path`."""
+    link_path = cache_path + '.link'
+    if os.path.lexists(link_path):
+        os.remove(link_path)
+
+    os.symlink(os.path.basename(version_path), link_path)
+    os.replace(link_path, cache_path)
+
+def carry_over(from_path, to_path):
+    """Move the renditions of `from_path` missing in `to_path`, e.g. ingested while re-rendering."""
+    for filename in os.listdir(from_path):
+        if filename.endswith('.part') or filename in (CHECKPOINT_FILENAME, PARAMS_FILENAME):
+            continue
+        if not os.path.exists(os.path.join(to_path, filename)):
+            os.replace(os.path.join(from_path, filename), os.path.join(to_path, filename))
+
+def recover_cache(cache_path, logger):
+    """
+    Bring a cache back to a consistent state after an interrupted swap, and clean up.
+
+    A cache is a `cache_WxH` symlink to the newest `cache_WxH.v<N>` directory. A
+    version directory only exists once a re-render is complete, so a newer version
+    than the one linked is a swap that did not finish: it is finished here. If no
+    version exists and the cache is gone, a leftover legacy directory is restored,
+    and a symlink left pointing to nothing is removed. The superseded directories
+    are then merged into the cache and deleted.
+    """
+    versions = list_cache_versions(cache_path)
+    legacy_paths = [cache_path + suffix for suffix in LEGACY_SUFFIXES
+                    if os.path.isdir(cache_path + suffix) and not os.path.islink(cache_path + suffix)]
+
+    current_path = os.path.realpath(cache_path) if os.path.exists(cache_path) else None
+
+    if versions and os.path.realpath(versions[-1]) != current_path:
+        if os.path.isdir(cache_path) and not os.path.islink(cache_path):
+            # First swap of a cache created before versioning
+            os.rename(cache_path, cache_path + LEGACY_SUFFIXES[0])
+            legacy_paths = [cache_path + LEGACY_SUFFIXES[0]] + [path for path in legacy_paths if path != cache_path + LEGACY_SUFFIXES[0]]
+        point_cache_to(cache_path, versions[-1])
+        logger.warning(f'Finished the swap of {cache_path} to {versions[-1]}')
+    elif current_path is None and legacy_paths:
+        if os.path.lexists(cache_path):
+            os.remove(cache_path)
+        os.rename(legacy_paths[0], cache_path)
+        logger.warning(f'Restored {cache_path} from {legacy_paths[0]}')
+        legacy_paths = legacy_paths[1:]
+
+    if not os.path.exists(cache_path):
+        # Dangling symlink, e.g. its version directory was deleted: drop it, so the cache can be created again
+        if os.path.islink(cache_path):
+            os.remove(cache_path)
+            logger.warning(f'Removed {cache_path}, it pointed to a missing directory')
+        return
+
+    current_path = os.path.realpath(cache_path)
+
+    # The swap is done, the checkpoint now records the parameters of the cache
+    if os.path.isfile(os.path.join(current_path, CHECKPOINT_FILENAME)):
+        os.replace(os.path.join(current_path, CHECKPOINT_FILENAME), os.path.join(current_path, PARAMS_FILENAME))
+
+    for path in versions + legacy_paths:
+        if os.path.realpath(path) == current_path:
+            continue
+        carry_over(path, current_path)
+        shutil.rmtree(path)
+        logger.info(f'Removed {path}, superseded by {current_path}')
+
+class CacheRenderer:
+    """
+    Re-renders every rendition of the ledger for the current resolution and JPEG
+    quality, from the largest rendition available on disk. Every cache records the
+    parameters it was rendered with, and a cache already rendered with the current
+    ones is left as is.
+
+    Renditions are written to a `<cache>.staging` directory by a process pool. A file
+    in the staging directory is complete, so an interrupted run resumes where it
+    stopped. Once every rendition is there, the staging directory becomes a new
+    version of the cache, and the cache symlink is atomically pointed to it. The
+    frame keeps showing the old cache in the meantime.
+    """
+    def __init__(self, media_repository, config_data, logger, workers=None):
+        self.media_repository = media_repository
+        self.config_data = config_data
+        self.logger = logger
+        self.workers = workers
+
+    def best_source(self, filename, caches):
+        for cache_path, _ in caches:
+            source_path = os.path.join(cache_path, filename)
+            if os.path.isfile(source_path):
+                return source_path
+        return None
+
+    def prepare_staging(self, staging_path, params):
+        """Create the staging directory, discarding a previous run made with other parameters."""
+        checkpoint_path = os.path.join(staging_path, CHECKPOINT_FILENAME)
+
+        if os.path.isdir(staging_path):
+            previous_params = None
+            if os.path.isfile(checkpoint_path):
+                with open(checkpoint_path, 'r') as file:
+                    previous_params = json.load(file)
+
+            if previous_params == params:
+                self.logger.info(f'Resuming re-render in {staging_path}')
+            else:
+                self.logger.info(f'Discarding {staging_path}, rendered with {previous_params}')
+                shutil.rmtree(staging_path)
+
+        os.makedirs(staging_path, exist_ok=True)
+        with open(checkpoint_path, 'w') as file:
+            json.dump(params, file, indent=4)
+
+    def swap(self, cache_path, staging_path):
+        """
+        Swap the staging directory in place of the cache with a single os.replace of
+        the cache symlink. A crash at any point is completed by recover_cache.
+        """
+        # Carry over the items ingested while re-rendering, so the frame finds them right after the swap
+        if os.path.isdir(cache_path):
+            carry_over(cache_path, staging_path)
+
+        versions = list_cache_versions(cache_path)
+        next_version = int(versions[-1].rsplit('.v', 1)[-1]) + 1 if versions else 1
+
+        # From here on the re-render is complete: recover_cache finishes the swap if interrupted
+        os.rename(staging_path, f'{cache_path}.v{next_version}')
+
+        recover_cache(cache_path, self.logger)
+
+    def render_cache(self, size):
+        """
+        Re-render the cache of one resolution. A cache already rendered with the
+        current parameters is not re-rendered, only its missing renditions are
+        rendered, straight into it.
+
+        :return: True if the cache is complete and up to date.
+        """
+        cache_path = self.config_data.get_cache_path_for_size(*size)
+        staging_path = cache_path + '.staging'
+        quality = self.config_data.config['jpeg_quality']
+        params = cache_params(size, quality)
+
+        recover_cache(cache_path, self.logger)
+
+        up_to_date = read_cache_params(cache_path) == params
+        if up_to_date:
+            # Re-rendering would only add another generation of JPEG loss
+            if os.path.isdir(staging_path):
+                shutil.rmtree(staging_path)
+            target_dir = cache_path
+        else:
+            self.prepare_staging(staging_path, params)
+            target_dir = staging_path
+
+        caches = self.config_data.get_existing_cache_paths()
+
+        # Upscaled from a smaller rendition, an oversized Ken Burns rendition would only be a soft copy of it:
+        # the items without a large enough source are left out, and shown without the effect
+        oversized = size not in self.config_data.get_monitor_sizes()
+        if oversized:
+            caches = [(path, cache_size) for path, cache_size in caches if cache_size[0] >= size[0] and cache_size[1] >= size[1]]
+
+        tasks = {}
+        missing = 0
+        skipped = 0
+        for entry in self.media_repository.local_ledger['data']:
+            target_path = os.path.join(target_dir, entry['filename'])
+            if os.path.isfile(target_path):
+                continue
+
+            source_path = self.best_source(entry['filename'], caches)
+            if source_path is None and oversized:
+                skipped += 1
+                continue
+            if source_path is None:
+                self.logger.error(f"No rendition of {entry['filename']} found")
+                missing += 1
+                continue
+
+            tasks[target_path] = (source_path, get_content_size(entry))
+
+        if skipped:
+            self.logger.warning(f'{skipped} items have no rendition large enough for {cache_path}, they are shown without the Ken Burns effect')
+
+        if up_to_date and not tasks and not missing:
+            self.logger.info(f'{cache_path} is up to date with {params}')
+            return True
+
+        self.logger.info(f'Rendering {len(tasks)} items into {target_dir} at quality {quality}')
+
+        failed = 0
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(render_rendition, source_path, target_path, size, quality, content_size): target_path
+                       for target_path, (source_path, content_size) in tasks.items()}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                try:
+                    future.result()
+                except Exception as e:
+                    self.logger.error(f'Error rendering {futures[future]}: {e}')
+                    failed += 1
+
+        if failed or missing:
+            self.logger.error(f'{failed} items failed and {missing} have no source. Run again to resume')
+            return False
+
+        if up_to_date:
+            self.logger.info(f'Rendered the missing items into {cache_path}')
+            return True
+
+        self.swap(cache_path, staging_path)
+        self.logger.info(f'Swapped the re-rendered cache into {cache_path}')
+        return True
+
+    def update_checksums(self):
+        cache_path = self.config_data.get_cache_path()
+        filenames = [entry['filename'] for entry in self.media_repository.local_ledger['data']
+                     if os.path.isfile(os.path.join(cache_path, entry['filename']))]
+        paths = [os.path.join(cache_path, filename) for filename in filenames]
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            checksums = dict(zip(filenames, executor.map(file_checksum, paths, chunksize=16)))
+
+        # The frame may have ingested new items in the meantime, merge into the ledger on disk
+        def set_checksums(entries):
+            for entry in entries:
+                if entry['filename'] in checksums:
+                    entry['checksum'] = checksums[entry['filename']]
+
+        self.media_repository.update_local_ledger(set_checksums)
+
+    def run(self):
+        rendered = [self.render_cache(size) for size in self.config_data.get_rendition_sizes()]
+        if not all(rendered):
+            return False
+
+        self.update_checksums()
+
+        if self.config_data.config['previous_cache_path']:
+            self.logger.info(f"Done re-rendering. {self.config_data.config['previous_cache_path']} is no longer shown")
+            self.config_data.config['previous_cache_path'] = None
+            self.config_data.save_config()
+
+        return True
@@ -3,13 +3,20 @@ import sys
 import json
 import os
 import logging
+import re
 
 EXIT_WARNING = 2
 EXIT_ERROR = 1
 
+def parse_cache_size(cache_name):
+    """Return the (width, height) encoded in a cache directory name such as cache_1920x1080."""
+    width, height = cache_name.rsplit('_', 1)[-1].split('x')
+    return int(width), int(height)
+
 class Monitor:
     def __init__(self):
         self.device = None
+        self.devices = []
 
     def initialize(self):
         _monitors = screeninfo.get_monitors()
@@ -26,13 +33,22 @@ class Monitor:
             logging.critical(f"No *primary* monitors found. Terminating program")
             sys.exit(EXIT_ERROR)
                 
+        # Keep every attached display, primary first
+        self.devices = [self.device] + [m for m in _monitors if m is not self.device]
+
         logging.info(f"Found active monitor.")
+        if len(self.devices) > 1:
+            logging.info(f"Found {len(self.devices)} attached monitors.")
 
 
     def get_size(self):
         assert(self.device is not None)
         return self.device.width, self.device.height
 
+    def get_displays(self):
+        assert(self.device is not None)
+        return [{'width': m.width, 'height': m.height, 'x': m.x, 'y': m.y} for m in self.devices]
+
 class ConfigRepository:
     def __init__(self, config_file_path, logger, monitor=None):
         """
@@ -57,9 +73,22 @@ class ConfigRepository:
             elif self.config['monitor_width'] != width or self.config['monitor_height'] != height:
                 self.logger.warning(f"Monitor size mismatch. Expected {self.config['monitor_width']}x{self.config['monitor_height']}, but got {width}x{height}.")
                 self.logger.warning(f"Setting monitor size to {width}x{height}")
+
+                # Keep showing the old renditions until the new cache is re-rendered
+                if self.config['previous_cache_path'] is None and os.path.isdir(self.get_cache_path()):
+                    self.config['previous_cache_path'] = self.get_cache_path()
+                    self.logger.warning(f"Showing {self.get_cache_path()} until the cache is re-rendered with --rerender-cache")
+
                 self.set_monitor(width, height) 
                 self.save_config()
 
+            if self.config['multi_display']:
+                displays = monitor.get_displays()
+                if self.config['displays'] != displays:
+                    self.logger.warning(f"Display layout changed. Expected {self.config['displays']}, but got {displays}.")
+                    self.config['displays'] = displays
+                    self.save_config()
+
         if not loaded:
             self.save_config()
             
@@ -73,7 +102,15 @@ class ConfigRepository:
         if os.path.exists(self.config_file_path):
             self.logger.info(f'Loading config file {self.config_file_path}')
             with open(self.config_file_path, 'r') as config_file:
-                self.config = json.load(config_file)
+                loaded_config = json.load(config_file)
+
+            # Keep defaults for the keys introduced after the config file was written
+            missing_keys = [key for key in self.config if key not in loaded_config]
+            self.config.update(loaded_config)
+
+            if missing_keys:
+                self.logger.info(f'Config file {self.config_file_path} is missing {missing_keys}. Setting them to defaults')
+                self.save_config()
             return True
         else:
             self.logger.info(f'Config file {self.config_file_path} does not exists. Setting to defaults')
@@ -95,9 +132,14 @@ class ConfigRepository:
 
     def set_defaults(self):
         self.config['cache_path_prefix'] = 'cache'
+        self.config['previous_cache_path'] = None
+        self.config['jpeg_quality'] = 95
         self.config['media_repository_path'] = 'media_repository.json'
         self.config['monitor_width'] = 0
         self.config['monitor_height'] = 0
+        self.config['multi_display'] = False
+        self.config['displays'] = []
+        self.config['ingest_interval'] = 3600
 
         #SFTP data
         self.config['sftp_address'] = 'your address'
@@ -106,21 +148,106 @@ class ConfigRepository:
         self.config['sftp_path'] = 'your path'
         self.config['sftp_path_ingest_new_items'] = 'your ingestion path'
         self.config['delete_after_ingest'] = True
+        self.config['sync_workers'] = 4
 
         #Display
         self.config['time_show'] = 35
+        self.config['transition_fps'] = 20
+        self.config['dwell_effect'] = 'static'
+        self.config['ken_burns_fps'] = 10
+        self.config['ken_burns_zoom'] = 1.15
+        self.config['ken_burns_scale_budget'] = 4
+
+        #Ingest
+        self.config['ingest_workers'] = 4
+        self.config['hash_batch_size'] = 8
+
+        #Thermal
+        self.config['thermal_sample_period'] = 10
+        self.config['thermal_warm_threshold'] = 70
+        self.config['thermal_hot_threshold'] = 78
+        self.config['thermal_hysteresis'] = 5
 
     def set_monitor(self, width, height):
         self.config['monitor_width'], self.config['monitor_height'] = width, height
 
-    def get_monitor_aspect_ratio(self):
-        return self.config['monitor_width'] / self.config['monitor_height']
+    def get_displays(self):
+        """
+        Return the displays to drive, primary first. Without `multi_display`, only the primary one.
+        """
+        if self.config['multi_display'] and self.config['displays']:
+            return self.config['displays']
+
+        return [{'width': self.config['monitor_width'], 'height': self.config['monitor_height'], 'x': 0, 'y': 0}]
+
+    def get_monitor_aspect_ratio(self, display=0):
+        width, height = self.get_monitor_size(display)
+        return width / height
     
-    def get_monitor_size(self):
-        return self.config['monitor_width'], self.config['monitor_height']
+    def get_monitor_size(self, display=0):
+        if display == 0:
+            return self.config['monitor_width'], self.config['monitor_height']
+
+        _display = self.get_displays()[display]
+        return _display['width'], _display['height']
+
+    def get_monitor_sizes(self):
+        """
+        Return the distinct resolutions of the displays. Displays sharing a resolution share a cache.
+        """
+        sizes = []
+        for display in range(len(self.get_displays())):
+            size = self.get_monitor_size(display)
+            if size not in sizes:
+                sizes.append(size)
+        return sizes
+
+    def get_ken_burns_size(self, display=0):
+        """
+        Return the size of the oversized rendition the Ken Burns effect pans over, `ken_burns_zoom`
+        times the display, or None if the effect is off.
+        """
+        if self.config['dwell_effect'] != 'ken_burns' or self.config['ken_burns_zoom'] <= 1:
+            return None
+
+        width, height = self.get_monitor_size(display)
+        return round(width * self.config['ken_burns_zoom']), round(height * self.config['ken_burns_zoom'])
+
+    def get_rendition_sizes(self):
+        """
+        Return the distinct resolutions of the renditions to keep: the displays, plus the oversized
+        renditions of the Ken Burns effect. Every one has its own cache.
+        """
+        sizes = self.get_monitor_sizes()
+        for display in range(len(self.get_displays())):
+            size = self.get_ken_burns_size(display)
+            if size is not None and size not in sizes:
+                sizes.append(size)
+        return sizes
+
+    def get_cache_path(self, display=0):
+        width, height = self.get_monitor_size(display)
+        return self.get_cache_path_for_size(width, height)
+
+    def get_cache_path_for_size(self, width, height):
+        return self.config['cache_path_prefix'] + '_' + str(width) + 'x' + str(height)
+
+    def get_existing_cache_paths(self):
+        """
+        Return the (path, (width, height)) of the rendition caches on disk, largest resolution first.
+        """
+        prefix = self.config['cache_path_prefix']
+        parent = os.path.dirname(prefix) or '.'
+        pattern = re.compile(re.escape(os.path.basename(prefix)) + r'_\d+x\d+$')
+
+        caches = []
+        if os.path.isdir(parent):
+            for name in os.listdir(parent):
+                path = os.path.join(os.path.dirname(prefix), name)
+                if pattern.match(name) and os.path.isdir(path):
+                    caches.append((path, parse_cache_size(name)))
 
-    def get_cache_path(self):
-        return self.config['cache_path_prefix'] + '_' + str(self.config['monitor_width']) + 'x' + str(self.config['monitor_height'])
+        return sorted(caches, key=lambda cache: cache[1][0] * cache[1][1], reverse=True)
 
     def update_config_if_changed(self):
         """
@@ -0,0 +1,269 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
+
+from media_repository import load_image_fix_orientation, hamming_distance, compute_phash, crop_letterbox, get_content_size
+
+HASH_BITS = 64
+CHUNK_BITS = 16
+NUM_CHUNKS = HASH_BITS // CHUNK_BITS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+def hash_cached_image(path_to_img, content_size=None):
+    """
+    Compute the perceptual hash of a cached rendition. Runs in a worker process.
+    The letterbox bars are cropped first, the hashes of the ledger are computed
+    on the source images, which have none.
+
+    Returns:
+        int: The hash, or None if the file cannot be read.
+    """
+    try:
+        return compute_phash(crop_letterbox(load_image_fix_orientation(path_to_img), content_size))
+    except Exception:
+        return None
+
+def flip_masks(radius, bits=CHUNK_BITS):
+    """Return every mask of `bits` bits with at most `radius` bits set."""
+    masks = []
+    for num_flips in range(radius + 1):
+        for positions in combinations(range(bits), num_flips):
+            mask = 0
+            for position in positions:
+                mask |= 1 << position
+            masks.append(mask)
+    return masks
+
+class UnionFind:
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, idx):
+        while self.parent[idx] != idx:
+            self.parent[idx] = self.parent[self.parent[idx]]
+            idx = self.parent[idx]
+        return idx
+
+    def union(self, idx1, idx2):
+        root1, root2 = self.find(idx1), self.find(idx2)
+        if root1 == root2:
+            return
+        # Keep the smallest index as root, so the oldest ledger entry represents the cluster
+        if root1 < root2:
+            self.parent[root2] = root1
+        else:
+            self.parent[root1] = root2
+
+class DuplicateClusterer:
+    """
+    Groups the ledger entries whose perceptual hashes are within a Hamming
+    distance of each other, across the whole library.
+    """
+    def __init__(self, media_repository, config_data, logger, max_distance=9, workers=None):
+        self.media_repository = media_repository
+        self.config_data = config_data
+        self.logger = logger
+        self.max_distance = max_distance
+        self.workers = workers
+
+    def fill_missing_hashes(self):
+        """
+        Recompute in parallel, from the cache, the hashes missing in the ledger.
+
+        :return: The hashes recomputed, by filename.
+        """
+        entries = [entry for entry in self.media_repository.local_ledger['data'] if entry.get('phash') is None]
+        if not entries:
+            return {}
+
+        self.logger.info(f'Recomputing {len(entries)} missing hashes from the cache')
+
+        paths = [self.find_rendition(entry['filename']) for entry in entries]
+        content_sizes = [get_content_size(entry) for entry in entries]
+        hashes = {}
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for entry, hash in zip(entries, executor.map(hash_cached_image, paths, content_sizes, chunksize=16)):
+                if hash is None:
+                    self.logger.error(f"Could not hash {entry['filename']}")
+                    continue
+                hashes[entry['filename']] = hash
+
+        return hashes
+
+    def cache_paths(self):
+        return [self.config_data.get_cache_path_for_size(*size) for size in self.config_data.get_rendition_sizes()]
+
+    def find_rendition(self, filename):
+        """Path of the rendition in the primary cache, or in the cache of another display if missing there."""
+        paths = [os.path.join(cache_path, filename) for cache_path in self.cache_paths()]
+        return next((path for path in paths if os.path.isfile(path)), paths[0])
+
+    def find_pairs(self, hashes):
+        """
+        Find every pair of hashes within `max_distance` bits, using multi-index hashing.
+
+        The 64-bit hash is split into 16-bit chunks. By the pigeonhole principle,
+        two hashes within distance k have at least one chunk within k // 4 bits,
+        so only the entries found by probing those chunk neighbourhoods are compared.
+
+        :param hashes: List of integer hashes, None for unknown.
+        :return: Set of (i, j) index pairs with i < j.
+        """
+        radius = self.max_distance // NUM_CHUNKS
+        masks = flip_masks(radius)
+
+        tables = [{} for _ in range(NUM_CHUNKS)]
+        for idx, hash in enumerate(hashes):
+            if hash is None:
+                continue
+            for chunk in range(NUM_CHUNKS):
+                key = (hash >> (chunk * CHUNK_BITS)) & CHUNK_MASK
+                tables[chunk].setdefault(key, []).append(idx)
+
+        pairs = set()
+        for idx, hash in enumerate(hashes):
+            if hash is None:
+                continue
+            for chunk in range(NUM_CHUNKS):
+                key = (hash >> (chunk * CHUNK_BITS)) & CHUNK_MASK
+                table = tables[chunk]
+                for mask in masks:
+                    for candidate in table.get(key ^ mask, ()):
+                        if candidate <= idx or (idx, candidate) in pairs:
+                            continue
+                        if hamming_distance(hash, hashes[candidate]) <= self.max_distance:
+                            pairs.add((idx, candidate))
+
+        return pairs
+
+    def find_clusters(self):
+        """
+        Group the ledger entries around the entries to keep.
+
+        Entries are visited in ledger order. The first one not grouped yet is kept,
+        and the entries within `max_distance` of it, not grouped yet, are its
+        duplicates. Every duplicate is hence close to the entry kept in its place,
+        even in a burst of slowly changing shots where A~B and B~C but A and C are
+        far apart. The other entries kept that are chained to the group through
+        near-duplicates are reported as related.
+
+        :return: List of clusters, dicts with the `keep` ledger index and the lists of
+                 `duplicates` and `related` ledger indexes, in ledger order.
+        """
+        entries = self.media_repository.local_ledger['data']
+        hashes = [entry.get('phash') for entry in entries]
+
+        neighbours = {}
+        union_find = UnionFind(len(entries))
+        for idx1, idx2 in self.find_pairs(hashes):
+            neighbours.setdefault(idx1, set()).add(idx2)
+            neighbours.setdefault(idx2, set()).add(idx1)
+            union_find.union(idx1, idx2)
+
+        components = {}
+        for idx in sorted(neighbours):
+            components.setdefault(union_find.find(idx), []).append(idx)
+
+        grouped = set()
+        kept = set()
+        clusters = []
+        for idx in sorted(neighbours):
+            if idx in grouped:
+                continue
+            kept.add(idx)
+
+            duplicates = sorted(neighbour for neighbour in neighbours[idx] if neighbour not in grouped)
+            grouped.add(idx)
+            grouped.update(duplicates)
+
+            if duplicates:
+                clusters.append({'keep': idx, 'duplicates': duplicates})
+
+        # The entries of the same chain that are not pruned
+        pruned = grouped - kept
+        for cluster in clusters:
+            component = components[union_find.find(cluster['keep'])]
+            cluster['related'] = [member for member in component if member != cluster['keep'] and member not in pruned]
+
+        return clusters
+
+    def write_report(self, clusters, report_path):
+        entries = self.media_repository.local_ledger['data']
+
+        def describe(keep, idx):
+            return {'filename': entries[idx]['filename'],
+                    'distance': hamming_distance(keep['phash'], entries[idx]['phash']),
+                    'recomputed_hash': entries[idx].get('phash_recomputed', False)}
+
+        report = {}
+        report['max_distance'] = self.max_distance
+        report['num_items'] = len(entries)
+        report['num_clusters'] = len(clusters)
+        report['num_duplicates'] = sum(len(cluster['duplicates']) for cluster in clusters)
+        # Hashes recomputed from the cached renditions are less accurate than the ones computed at ingest
+        report['num_recomputed_hashes'] = sum(1 for entry in entries if entry.get('phash_recomputed'))
+        report['clusters'] = []
+        for cluster in clusters:
+            keep = entries[cluster['keep']]
+            report_cluster = {}
+            report_cluster['keep'] = keep['filename']
+            report_cluster['keep_recomputed_hash'] = keep.get('phash_recomputed', False)
+            report_cluster['duplicates'] = [describe(keep, idx) for idx in cluster['duplicates']]
+            # Chained to the cluster, but further than max_distance from the entry kept: never pruned
+            report_cluster['related'] = [describe(keep, idx) for idx in cluster['related']]
+            report['clusters'].append(report_cluster)
+
+        with open(report_path, 'w') as file:
+            json.dump(report, file, indent=4)
+
+        self.logger.info(f"Found {report['num_duplicates']} near-duplicates in {report['num_clusters']} clusters. Report saved to {report_path}")
+
+        return report
+
+    def prune(self, clusters):
+        """
+        Remove the duplicates of every cluster from the ledger and the caches. The
+        entries kept and the related ones stay.
+
+        :return: The number of entries removed.
+        """
+        entries = self.media_repository.local_ledger['data']
+        to_remove = set(entries[idx]['filename'] for cluster in clusters for idx in cluster['duplicates'])
+
+        for filename in sorted(to_remove):
+            # Every display has its own rendition
+            for cache_path in self.cache_paths():
+                path_to_img = os.path.join(cache_path, filename)
+                if os.path.exists(path_to_img):
+                    os.remove(path_to_img)
+            self.logger.info(f"Pruned {filename}")
+
+        # Remove by filename from the ledger on disk, the frame may have ingested new items in the meantime
+        def remove_pruned(entries):
+            entries[:] = [entry for entry in entries if entry['filename'] not in to_remove]
+
+        self.media_repository.update_local_ledger(remove_pruned)
+
+        return len(to_remove)
+
+    def run(self, report_path, prune=False):
+        hashes = self.fill_missing_hashes()
+        if hashes:
+            def set_hashes(entries):
+                for entry in entries:
+                    if entry['filename'] in hashes:
+                        entry['phash'] = hashes[entry['filename']]
+                        # Hashed from a rendition, not the source: flagged in the report
+                        entry['phash_recomputed'] = True
+
+            self.media_repository.update_local_ledger(set_hashes)
+
+        clusters = self.find_clusters()
+        report = self.write_report(clusters, report_path)
+
+        if prune and clusters:
+            removed = self.prune(clusters)
+            self.logger.info(f"Removed {removed} near-duplicates from the ledger")
+
+        return report
@@ -0,0 +1,85 @@
+import random
+
+import pygame
+
+class KenBurnsEffect:
+    """
+    Pan and zoom over an image during the dwell phase, with plain blits.
+
+    The image is the oversized rendition, `ken_burns_zoom` times the screen size,
+    rendered from the source at ingest, so it is never upscaled. Every frame is a
+    screen-size subsurface of it, blitted as is, at whole-pixel positions: no
+    scaling per frame, and a slow pan leaves most frames unchanged, so they are
+    not redrawn.
+
+    The zoom steps through `scale_budget` levels: the image itself and smaller
+    copies, smoothscaled once when the effect is created, before the crossfade.
+    Between two steps, the view only pans. The levels take up to `scale_budget`
+    times the memory of the image.
+    """
+    def __init__(self, image, screen_size, duration, fps, scale_budget=4):
+        self.screen_width, self.screen_height = screen_size
+        num_levels = max(1, scale_budget)
+
+        image_width, image_height = image.get_size()
+        zoom = max(1.0, min(image_width / self.screen_width, image_height / self.screen_height))
+
+        # Zoom between the square root of `zoom` and `zoom`, so even the smallest zoom leaves room to pan
+        min_scale = zoom ** 0.5
+        if num_levels == 1:
+            scales = [zoom]
+        else:
+            scales = [min_scale * (zoom / min_scale) ** (level / (num_levels - 1)) for level in range(num_levels)]
+
+        image = image.convert()
+        self.level_surfaces = [pygame.transform.smoothscale(image, self.level_size(scale)) for scale in scales[:-1]] + [image]
+
+        self.crops = self.compute_crops(max(1, int(duration * fps)), 0.5 / min_scale)
+
+    def level_size(self, scale):
+        return (max(self.screen_width, round(self.screen_width * scale)),
+                max(self.screen_height, round(self.screen_height * scale)))
+
+    def compute_crops(self, num_frames, margin):
+        """
+        Return the (level, x, y) of the screen-size crop of every frame.
+
+        The view is defined in normalized image coordinates, independent of the
+        level, so a zoom step does not move the framing.
+        """
+        zoom_in = random.random() < 0.5
+        num_levels = len(self.level_surfaces)
+
+        # Pan between two random centers, valid at the smallest zoom and hence at all of them
+        center_start = [random.uniform(margin, 1 - margin) for _ in range(2)]
+        center_end = [random.uniform(margin, 1 - margin) for _ in range(2)]
+
+        crops = []
+        for idx in range(num_frames):
+            t = idx / max(1, num_frames - 1)
+
+            # Spend the same time on every level
+            level = min(num_levels - 1, int(t * num_levels))
+            if not zoom_in:
+                level = num_levels - 1 - level
+            level_width, level_height = self.level_surfaces[level].get_size()
+
+            center_x = center_start[0] + (center_end[0] - center_start[0]) * t
+            center_y = center_start[1] + (center_end[1] - center_start[1]) * t
+            x = min(max(0, round(center_x * level_width - self.screen_width / 2)), level_width - self.screen_width)
+            y = min(max(0, round(center_y * level_height - self.screen_height / 2)), level_height - self.screen_height)
+
+            crops.append((level, x, y))
+
+        return crops
+
+    def frame_index(self, progress):
+        return min(len(self.crops) - 1, int(progress * len(self.crops)))
+
+    def changed(self, index1, index2):
+        """True if two frames show a different crop."""
+        return self.crops[index1] != self.crops[index2]
+
+    def frame(self, index):
+        level, x, y = self.crops[index]
+        return self.level_surfaces[level].subsurface((x, y, self.screen_width, self.screen_height))
@@ -0,0 +1,146 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, RotatingFileHandler
+
+_STOP = object()
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Queue handler that hands the record over without formatting it. The stock
+    handler formats the whole record in the calling thread, here only the message
+    arguments are merged, and the rest of the formatting happens in the writer
+    thread, so the caller only pays for the queue append.
+    """
+    def prepare(self, record):
+        # Render the arguments now, they could be mutated before the writer thread gets to them
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+class BatchedRotatingFileHandler(RotatingFileHandler):
+    """
+    Rotating file handler that does not flush after every record. Flushes are
+    triggered by the AsyncLogWriter through force_flush().
+    """
+    def flush(self):
+        pass
+
+    def force_flush(self):
+        super().flush()
+
+class RepeatedMessageFilter(logging.Filter):
+    """
+    Let through at most `burst` identical messages every `period` seconds. The
+    number of dropped messages is appended to the next one let through.
+    """
+    def __init__(self, burst=5, period=60):
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self.windows = {}
+
+    def filter(self, record):
+        key = (record.levelno, record.getMessage())
+        now = time.monotonic()
+
+        window_start, count, suppressed = self.windows.get(key, (now, 0, 0))
+        if now - window_start >= self.period:
+            window_start, count = now, 0
+
+        if count >= self.burst:
+            self.windows[key] = (window_start, count, suppressed + 1)
+            return False
+
+        if suppressed:
+            record.msg = f"{record.getMessage()} (suppressed {suppressed} repeated messages)"
+            record.args = None
+
+        self.windows[key] = (window_start, count + 1, 0)
+
+        # Forget the windows that have expired, so the table does not grow with unique messages
+        if len(self.windows) > 1024:
+            self.windows = {k: v for k, v in self.windows.items() if now - v[0] < self.period or v[2]}
+
+        return True
+
+class AsyncLogWriter:
+    """
+    Dedicated thread writing the queued records to the file handler. The file is
+    flushed every `flush_records` records, after `flush_interval` seconds without
+    a flush, and right away for errors.
+    """
+    def __init__(self, handler, flush_records=64, flush_interval=2.0):
+        self.handler = handler
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='AsyncLogWriter', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+
+        self.queue.put(_STOP)
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        pending = 0
+        last_flush = time.monotonic()
+
+        while True:
+            try:
+                record = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                record = None
+
+            if record is _STOP:
+                break
+
+            if record is not None:
+                self.handler.handle(record)
+                pending += 1
+
+                if record.levelno >= logging.ERROR:
+                    pending = self.flush_records
+
+            if pending and (pending >= self.flush_records or time.monotonic() - last_flush >= self.flush_interval):
+                self.handler.force_flush()
+                pending = 0
+                last_flush = time.monotonic()
+
+        self.handler.force_flush()
+        self.handler.close()
+
+def get_logger(name, log_filename):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+
+    # Create a rotating file handler which logs even debug messages
+    # up to 10MB in size, keeping up to 5 backup files
+    fh = BatchedRotatingFileHandler(log_filename, mode='a', maxBytes=10*1024*1024, backupCount=5)
+    fh.setLevel(logging.DEBUG)
+
+    # Create formatter and add it to the handlers
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    fh.setFormatter(formatter)
+    fh.addFilter(RepeatedMessageFilter())
+
+    # The file is written from a dedicated thread, callers only append to a queue
+    writer = AsyncLogWriter(fh)
+    writer.start()
+    atexit.register(writer.stop)
+
+    # Add the handler to the logger
+    logger.addHandler(NonBlockingQueueHandler(writer.queue))
+
+    return logger
@@ -1,10 +1,13 @@
 
+import fcntl
 import hashlib
 import json
 import os
 import io
 import sys
 import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager
 
 import logging
 import random
@@ -76,6 +79,160 @@ def load_image_fix_orientation(image_path):
         logging.error(f"Unexpected error: {image_path} - {e}")
         raise
 
+def hamming_distance(hash1, hash2):
+    """Number of differing bits between two integer hashes."""
+    return bin(hash1 ^ hash2).count('1')
+
+def compute_phash(img):
+    """Perceptual hash of an image, as a 64-bit integer."""
+    return int(str(imagehash.phash(img)), 16)
+
+def file_checksum(path, block_size=1024 * 1024):
+    """SHA-256 of a file, read in blocks so large files are never fully loaded."""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def read_image_metadata(image_path):
+    """
+    Read the metadata stored in the v2 ledger from a source image. Only the
+    image header is parsed, pixels are not decoded.
+
+    Returns:
+        dict: Orientation-fixed width and height, byte size and capture date (None if unknown).
+    """
+    metadata = {}
+    with Image.open(image_path) as image:
+        width, height = image.size
+        exif_data = image._getexif() if hasattr(image, '_getexif') else None
+
+    exif_data = exif_data or {}
+
+    # Orientations 5 to 8 are rotated by 90 degrees
+    if exif_data.get(274, 1) in (5, 6, 7, 8):
+        width, height = height, width
+
+    metadata['width'] = width
+    metadata['height'] = height
+    metadata['bytes'] = os.path.getsize(image_path)
+    # DateTimeOriginal, falling back to DateTime
+    metadata['capture_date'] = exif_data.get(36867, exif_data.get(306))
+
+    return metadata
+
+def describe_rendition(path_to_img):
+    """
+    Compute the v2 ledger metadata of an entry from its cached rendition, for
+    entries ingested before v2. Runs in a worker process.
+
+    The source is gone, so its size, byte size and capture date are unknown and
+    left to None. Only the checksum of the rendition is computed.
+    """
+    metadata = {'width': None, 'height': None, 'bytes': None, 'capture_date': None, 'checksum': None}
+
+    if os.path.isfile(path_to_img):
+        metadata['checksum'] = file_checksum(path_to_img)
+
+    return metadata
+
+def fit_box(img_size, size):
+    """
+    Return the (x, y, width, height) an image of `img_size` takes once letterboxed by fit_image into `size`.
+    """
+    monitor_width, monitor_height = size
+
+    # Calculate the maximum size for the image to fit within the monitor while keeping its aspect ratio
+    img_width, img_height = img_size
+    ratio = min(monitor_width / img_width, monitor_height / img_height)
+    new_width, new_height = int(img_width * ratio), int(img_height * ratio)
+
+    # Calculate the position to center the image
+    return (monitor_width - new_width) // 2, (monitor_height - new_height) // 2, new_width, new_height
+
+def fit_image(img, size):
+    """
+    Letterbox an image into a black image of the given size, keeping its aspect ratio.
+
+    Args:
+        img (Image): The image to fit.
+        size (tuple): The (width, height) of the monitor.
+
+    Returns:
+        Image: The fitted image.
+    """
+    x, y, new_width, new_height = fit_box(img.size, size)
+
+    # Resize the image
+    img = img.resize((new_width, new_height))
+
+    # Create a new black image with the monitor's size
+    back = Image.new('RGB', size, (0, 0, 0))
+
+    # Paste the resized image onto the black background
+    back.paste(img, (x, y))
+
+    return back
+
+def same_aspect_ratio(size1, size2, tolerance=0.01):
+    return abs(size1[0] / size1[1] - size2[0] / size2[1]) <= tolerance * size2[0] / size2[1]
+
+def crop_letterbox(img, content_size=None, threshold=16):
+    """
+    Crop the letterbox bars fit_image added to a rendition.
+
+    With the size of the source image, the bars are known exactly. Without it,
+    e.g. for entries migrated from v1, they are detected: pixels darker than
+    `threshold` count as bars, so the JPEG noise in them is ignored. fit_image
+    only adds bars of the same size on two opposite sides, so only the part dark
+    on both sides is cropped, on a single axis; a photo with a single dark edge
+    keeps it.
+
+    Returns:
+        Image: The picture inside the bars.
+    """
+    if content_size is not None:
+        x, y, width, height = fit_box(content_size, img.size)
+        return img.crop((x, y, x + width, y + height))
+
+    bbox = img.convert('L').point(lambda value: 255 if value > threshold else 0).getbbox()
+    if bbox is None:
+        return img
+
+    img_width, img_height = img.size
+    left, top, right, bottom = bbox
+    margin_x = min(left, img_width - right)
+    margin_y = min(top, img_height - bottom)
+
+    if margin_x >= margin_y:
+        return img.crop((margin_x, 0, img_width - margin_x, img_height))
+    return img.crop((0, margin_y, img_width, img_height - margin_y))
+
+def get_content_size(entry):
+    """Size of the source image of a ledger entry, None if unknown."""
+    if entry.get('width') and entry.get('height'):
+        return entry['width'], entry['height']
+    return None
+
+def render_rendition(source_path, target_path, size, quality, content_size=None):
+    """
+    Render a cached rendition from another one. Runs in a worker process.
+    When the aspect ratio changes, the bars of the source are cropped first, so
+    the picture is not letterboxed twice; `content_size` is the size of the
+    source image, if known. The file is written next to the target and renamed
+    once complete.
+
+    Returns:
+        str: The checksum of the new rendition.
+    """
+    img = load_image_fix_orientation(source_path)
+    if not same_aspect_ratio(img.size, size):
+        img = crop_letterbox(img, content_size)
+    fit_image(img, size).save(target_path + '.part', 'JPEG', quality=quality)
+    os.replace(target_path + '.part', target_path)
+    return file_checksum(target_path)
+
 class SFTPClient:
     def __init__(self, host, username, password, port=22):
         self.host = host
@@ -138,7 +295,7 @@ class SFTPClient:
         try:
             self.sftp.stat(remote_path)
             return True
-        except paramiko.SFTPError:
+        except (paramiko.SFTPError, IOError):
             return False
  
     def close(self):
@@ -172,6 +329,39 @@ class SFTPClient:
             raise
 
     
+    def upload_bytes(self, data, remote_path):
+        try:
+            self.sftp.putfo(io.BytesIO(data), remote_path)
+        except paramiko.SFTPError as e:
+            self.logger.error(f"Error uploading file: {e}")
+            raise
+        except Exception as e:
+            self.logger.error(f"Error uploading file: {e}")
+            raise
+
+    def rename(self, old_remote_path, new_remote_path):
+        try:
+            self.sftp.posix_rename(old_remote_path, new_remote_path)
+        except paramiko.SFTPError as e:
+            self.logger.error(f"Error renaming {old_remote_path}: {e}")
+            raise
+        except Exception as e:
+            self.logger.error(f"Error renaming {old_remote_path}: {e}")
+            raise
+
+    def make_dir(self, remote_path):
+        if self.file_exists(remote_path):
+            return
+        try:
+            self.sftp.mkdir(remote_path)
+            self.logger.info(f"Directory created {remote_path}")
+        except paramiko.SFTPError as e:
+            self.logger.error(f"Error creating directory {remote_path}: {e}")
+            raise
+        except Exception as e:
+            self.logger.error(f"Error creating directory {remote_path}: {e}")
+            raise
+
     def download_file_bytes(self, remote_path):
         with tempfile.TemporaryFile() as tmp:
             self.sftp.getfo(remote_path, tmp)
@@ -203,7 +393,7 @@ class MediaRepository:
         self.local_ledger = {}
         self.local_ledger['data'] = []
         self.local_ledger['info'] = {}
-        self.local_ledger['info']['version'] = 1
+        self.local_ledger['info']['version'] = 2
         
 
     
@@ -226,19 +416,38 @@ class MediaRepository:
         # Select random name
         img_data['filename'] = filename
 
+        img_data.update(describe_rendition(path_to_img))
+
         self.local_ledger['data'].append(img_data)
 
         return True
     
+    def analyze_image(self, remote_path):
+        """
+        Compute the perceptual hash of an image and read its metadata. Safe to run from worker threads.
+        The decoded image is dropped before returning, so a batch never keeps all of them in memory.
+
+        Returns:
+            tuple: The hash and the metadata of the image.
+        """
+        metadata = read_image_metadata(remote_path)
+        return self.compute_hash(load_image_fix_orientation(remote_path)), metadata
+
     def add_image(self, remote_path):
         
-        img = load_image_fix_orientation(remote_path)
+        hash, metadata = self.analyze_image(remote_path)
+
+        return self.insert_image(remote_path, hash, metadata)
+
+    def insert_image(self, remote_path, hash, metadata):
+        """
+        Insert an analyzed image in the ledger and save its renditions. Only images
+        that are not duplicates are decoded again, one at a time.
+        """
 
         img_data = {}
 
         # Check if image is already in ---------------
-        hash = self.compute_hash(img)
-                
         for curr_img_ledger in self.local_ledger['data']:
             if self.compare_hash(curr_img_ledger['phash'], hash):
                 return False
@@ -248,31 +457,106 @@ class MediaRepository:
         # Select random name
         img_data['filename'] = self.random_name() + '.jpg'
 
-        # Convert image to monitor resolution
-        img_resized = self.prepare_image(img)
+        # Convert image to the resolution of every display
+        self.save_renditions(load_image_fix_orientation(remote_path), img_data['filename'])
 
-        path_to_save = os.path.join(self.config_data.get_cache_path(), img_data['filename'])
-        img_resized.save(path_to_save, 'JPEG', quality=95)
+        img_data.update(metadata)
+        img_data['checksum'] = file_checksum(os.path.join(self.config_data.get_cache_path(), img_data['filename']))
 
         self.local_ledger['data'].append(img_data)
 
         return True
                 
+    def save_rendition(self, img, filename, size):
+        img_resized = self.prepare_image(img, size)
+
+        path_to_save = os.path.join(self.config_data.get_cache_path_for_size(*size), filename)
+        img_resized.save(path_to_save, 'JPEG', quality=self.config_data.config['jpeg_quality'])
+
+    def save_renditions(self, img, filename):
+        """
+        Save one rendition per distinct rendition resolution, concurrently. Resizing and
+        JPEG encoding release the GIL, so the renditions are produced in parallel.
+        """
+        sizes = self.config_data.get_rendition_sizes()
+
+        if len(sizes) == 1:
+            self.save_rendition(img, filename, sizes[0])
+            return
+
+        # Decode once before sharing the image between threads
+        img.load()
+        with ThreadPoolExecutor(max_workers=len(sizes)) as executor:
+            for future in [executor.submit(self.save_rendition, img, filename, size) for size in sizes]:
+                future.result()
+
+    def get_rendition_path(self, filename, display=0):
+        """
+        Path of the rendition to show. While the cache of a new resolution is being
+        re-rendered, the items not in it yet are taken from the previous cache.
+        """
+        path = os.path.join(self.config_data.get_cache_path(display), filename)
+
+        previous_cache_path = self.config_data.config['previous_cache_path']
+        if display == 0 and previous_cache_path and not os.path.isfile(path):
+            previous_path = os.path.join(previous_cache_path, filename)
+            if os.path.isfile(previous_path):
+                return previous_path
+
+        return path
+
+    def get_ken_burns_path(self, filename, display=0):
+        """
+        Path of the oversized rendition the Ken Burns effect pans over. None if the
+        effect is off, or the rendition is missing, e.g. for items ingested before
+        the effect was enabled and not re-rendered yet.
+        """
+        size = self.config_data.get_ken_burns_size(display)
+        if size is None:
+            return None
+
+        path = os.path.join(self.config_data.get_cache_path_for_size(*size), filename)
+        return path if os.path.isfile(path) else None
 
     def compare_hash(self, hash1, hash2, threshold=10):
-        diff = abs(hash1 - hash2)
-        return diff < threshold
+        return hamming_distance(hash1, hash2) < threshold
 
     def compute_hash(self, img):
-        return int(str(imagehash.phash(img)), 16) 
+        return compute_phash(img)
     
     def random_name(self, length = 10):
         """Generate a random alphanumeric string of a specified length."""
         return ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(length))
    
     def save_local_ledger(self):
-        with open(self.config_data.config['media_repository_path'], "w") as file:
+        # Write to a temporary file and swap it in, so display processes never read a partial ledger
+        ledger_path = self.config_data.config['media_repository_path']
+        with open(ledger_path + '.tmp', "w") as file:
             json.dump(self.local_ledger, file, indent=4)
+        os.replace(ledger_path + '.tmp', ledger_path)
+
+    @contextmanager
+    def ledger_lock(self):
+        """Exclusive lock on the ledger across processes, held while it is re-read, modified and saved."""
+        with open(self.config_data.config['media_repository_path'] + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def update_local_ledger(self, update):
+        """
+        Apply `update` to the ledger and save it. The frame ingests while the
+        maintenance commands run, so the ledger is re-read under the lock first:
+        the changes saved by the other process are kept instead of overwritten
+        by a stale copy. `update` receives the list of entries and modifies it
+        in place, matching entries by filename.
+        """
+        with self.ledger_lock():
+            self.load_local_ledger()
+            update(self.local_ledger['data'])
+            self.save_local_ledger()
 
     def load_local_ledger(self):
         if os.path.isfile(self.config_data.config['media_repository_path']):
@@ -294,10 +578,40 @@ class MediaRepository:
         return new_data
 
 
+    def update_to_v2(self, batch_size=64):
+        """
+        Add width, height, bytes, capture_date and checksum to every entry.
+
+        The migration streams over the ledger in batches computed by a process pool,
+        and checkpoints the ledger after each batch. Entries that already have a
+        checksum are skipped, so an interrupted migration resumes where it stopped.
+        """
+        pending = [entry for entry in self.local_ledger['data'] if 'checksum' not in entry]
+
+        if pending:
+            logging.info(f"Migrating {len(pending)} ledger entries to version 2")
+
+            cache_path = self.config_data.get_cache_path()
+            with ProcessPoolExecutor() as executor:
+                for start in range(0, len(pending), batch_size):
+                    batch = pending[start:start + batch_size]
+                    paths = [os.path.join(cache_path, entry['filename']) for entry in batch]
+
+                    for entry, metadata in zip(batch, executor.map(describe_rendition, paths)):
+                        if metadata['checksum'] is None:
+                            logging.error(f"{entry['filename']} not found in {cache_path}")
+                        entry.update(metadata)
+
+                    self.save_local_ledger()
+                    logging.info(f"Migrated {min(start + batch_size, len(pending))}/{len(pending)} ledger entries")
+
+        self.local_ledger['info']['version'] = 2
+        return self.local_ledger
+
     def check_and_upgrade_ledger(self):
 
         has_been_updated = False
-        last_version = 1
+        last_version = 2
         current_version = None
         if isinstance(self.local_ledger, list):
             #This is version 0
@@ -306,7 +620,8 @@ class MediaRepository:
             current_version = self.local_ledger['info']['version']
 
         update_functions = {
-            1: self.update_to_v1            
+            1: self.update_to_v1,
+            2: self.update_to_v2
         }
 
         for version in range(current_version + 1, last_version + 1):
@@ -322,26 +637,9 @@ class MediaRepository:
         return
 
         
-    def prepare_image(self, img):
+    def prepare_image(self, img, size=None):
         # Get the size of the monitor (width, height)
-        monitor_width, monitor_height = self.config_data.get_monitor_size()
-        
-        # Calculate the maximum size for the image to fit within the monitor while keeping its aspect ratio
-        img_width, img_height = img.size
-        ratio = min(monitor_width / img_width, monitor_height / img_height)
-        new_size = (int(img_width * ratio), int(img_height * ratio))
-        
-        # Resize the image
-        img = img.resize(new_size)
-        
-        # Create a new black image with the monitor's size
-        back = Image.new('RGB', (monitor_width, monitor_height), (0, 0, 0))
-        
-        # Calculate the position to center the image
-        x = (monitor_width - new_size[0]) // 2
-        y = (monitor_height - new_size[1]) // 2
-        
-        # Paste the resized image onto the black background
-        back.paste(img, (x, y))
+        if size is None:
+            size = self.config_data.get_monitor_size()
 
-        return back
+        return fit_image(img, size)
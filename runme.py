@@ -3,10 +3,9 @@ import os
 import screeninfo
 
 import logging
-from logging.handlers import RotatingFileHandler
 
 import sys
-import platform
+import signal
 import json
 import random
 import time
@@ -16,34 +15,26 @@ import tempfile
 from tqdm import tqdm
 import argparse
 import requests
-
-from config_engine import ConfigRepository, Monitor
-from media_repository import MediaRepository, SFTPClient
+import multiprocessing
+from multiprocessing.connection import wait
+from concurrent.futures import ThreadPoolExecutor
+
+from cache_engine import CacheRenderer, create_cache, recover_cache
+from config_engine import ConfigRepository, Monitor, EXIT_ERROR
+from media_repository import MediaRepository, SFTPClient, fit_box
+from duplicate_engine import DuplicateClusterer
+from effect_engine import KenBurnsEffect
+from log_engine import get_logger
+from sync_engine import LibrarySync
+from thermal_engine import ThermalGovernor, ThermalSampler
 
 VERSION = '1.0/25022025'
 
-def get_cpu_temperature():
-    """
-    Returns the current CPU temperature in degrees Celsius.
-    If the machine is not running Linux, returns 0.
-    """
-    # Check if the machine is running Linux
-    if platform.system() != 'Linux':
-        return 0
- 
-    # Check if the temperature file exists
-    temp_file = '/sys/class/thermal/thermal_zone0/temp'
-    if not os.path.exists(temp_file):
-        return 0
- 
-    # Read the temperature from the sysfs file
-    with open(temp_file, 'r') as f:
-        temp = f.read().strip()
-    
-    # Convert the temperature from millidegrees Celsius to degrees Celsius
-    temp = int(temp) / 1000
-    
-    return temp
+# Consecutive renditions failing to load before the slideshow backs off
+MAX_FAILED_LOADS = 5
+
+# SDL video drivers able to show a fullscreen window per display from separate processes
+MULTI_DISPLAY_VIDEO_DRIVERS = ['x11', 'wayland']
 
 def test_internet(timeout=1):
     """
@@ -74,13 +65,17 @@ def check_execution_paths():
 
 def startup_checks(config_data):
     
-    _cache_path = config_data.get_cache_path()
+    for width, height in config_data.get_rendition_sizes():
+        _cache_path = config_data.get_cache_path_for_size(width, height)
+
+        # Finish or roll back a cache swap interrupted by a crash
+        recover_cache(_cache_path, logging)
 
-    if not os.path.exists(_cache_path):
-        logging.debug(f'Cache path not exists. Creating {_cache_path}')
-        os.makedirs(_cache_path)
+        if not os.path.exists(_cache_path):
+            logging.debug(f'Cache path not exists. Creating {_cache_path}')
+            create_cache(_cache_path, (width, height), config_data.config['jpeg_quality'])
 
-def update_ledger(mediaRepository, configData):
+def update_ledger(mediaRepository, configData, governor):
 
     sftp = SFTPClient(configData.config['sftp_address'], 
                       configData.config['sftp_user'], 
@@ -92,25 +87,48 @@ def update_ledger(mediaRepository, configData):
     files_to_test = sftp.list_files(configData.config['sftp_path_ingest_new_items'])
     
     if files_to_test:
-        for curr_file in tqdm(files_to_test):
-            curr_file_full_path = os.path.join(configData.config['sftp_path_ingest_new_items'], curr_file)
+        with tqdm(total=len(files_to_test)) as progress_bar:
+            while files_to_test:
+                # Batch size and worker count are re-read per batch so the governor can throttle a long ingest
+                batch_size = governor.hash_batch_size()
+                batch, files_to_test = files_to_test[:batch_size], files_to_test[batch_size:]
 
-            file_extension = os.path.splitext(curr_file)[1]
-            sftp.download_file(curr_file_full_path, '/tmp' , 'tmp' + file_extension)
+                local_files = []
+                for idx, curr_file in enumerate(batch):
+                    curr_file_full_path = os.path.join(configData.config['sftp_path_ingest_new_items'], curr_file)
 
-            if mediaRepsitory.add_image('/tmp/tmp' + file_extension) is False:
-                logging.error(f'{curr_file} is a duplicate')
-            else:
-                logging.info(f'{curr_file} inserted to media repository')
-            
-            if configData.config['delete_after_ingest']:
-                logging.info(f'Deleting {curr_file_full_path}')
-                sftp.delete_file(curr_file_full_path)
+                    file_extension = os.path.splitext(curr_file)[1]
+                    local_filename = 'tmp' + str(idx) + file_extension
+                    sftp.download_file(curr_file_full_path, '/tmp', local_filename)
+                    local_files.append(os.path.join('/tmp', local_filename))
+
+                # Decoding and hashing run in parallel, insertion in the ledger stays sequential. Workers only
+                # return the hash and metadata, so at most one decoded image per worker is alive at a time
+                with ThreadPoolExecutor(max_workers=governor.ingest_workers()) as executor:
+                    analyzed = list(executor.map(mediaRepository.analyze_image, local_files))
+
+                def insert_batch(entries):
+                    for curr_file, local_file, (hash, metadata) in zip(batch, local_files, analyzed):
+                        if mediaRepository.insert_image(local_file, hash, metadata) is False:
+                            logging.error(f'{curr_file} is a duplicate')
+                        else:
+                            logging.info(f'{curr_file} inserted to media repository')
 
-            if os.path.exists('/tmp/tmp' + file_extension):
-                os.remove('/tmp/tmp' + file_extension)
+                # The ledger is re-read before inserting, so the changes saved by a maintenance command
+                # (re-render, prune, sync) since it was loaded are not overwritten
+                mediaRepository.update_local_ledger(insert_batch)
 
-            mediaRepsitory.save_local_ledger()
+                for curr_file, local_file in zip(batch, local_files):
+                    curr_file_full_path = os.path.join(configData.config['sftp_path_ingest_new_items'], curr_file)
+
+                    if configData.config['delete_after_ingest']:
+                        logging.info(f'Deleting {curr_file_full_path}')
+                        sftp.delete_file(curr_file_full_path)
+
+                    if os.path.exists(local_file):
+                        os.remove(local_file)
+
+                progress_bar.update(len(batch))
 
     # test_ledger_integrity(mediaRepository, configData)
 
@@ -141,26 +159,6 @@ def update_ledger(mediaRepository, configData):
 #         mediaRepsitory.save_local_ledger()
 
 
-def get_logger(name, log_filename):
-    logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)
-    logger.propagate = False
-    
-    # Create a rotating file handler which logs even debug messages
-    # up to 10MB in size, keeping up to 5 backup files
-    fh = RotatingFileHandler(log_filename, mode='a', maxBytes=10*1024*1024, backupCount=5)
-    fh.setLevel(logging.DEBUG)
-    
-    # Create formatter and add it to the handlers
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    fh.setFormatter(formatter)
-    
-    # Add the handler to the logger
-    logger.addHandler(fh)
-    
-    return logger
-
-
 def blend_images(screen, image1, image2, progress):
     """
     Blend two images onto the screen.
@@ -190,86 +188,117 @@ def blend_images(screen, image1, image2, progress):
     pygame.display.update()
 
 
-if __name__ == '__main__':
-
-    parser = argparse.ArgumentParser(description='Memory Lane')
-    parser.add_argument('--no-update-ledger', action='store_true', help='Do not update ledger from cloud')
-    parser.add_argument('--log-analytics', action='store_true', help='Log analytics data')
-    args = parser.parse_args()
-
-    logging = get_logger('MemoryLane', '/tmp/MemoryLane.log')
-
-    logging.info(f"Starting! Running version {VERSION}")
-
-    check_execution_paths()
+def fit_to_screen(image, screen_size):
+    """
+    Letterbox an image of another resolution into the screen, e.g. a rendition of
+    the previous cache while the current one is being re-rendered.
 
-    monitor = Monitor()
-    monitor.initialize()
+    Args:
+        image (pygame.Surface): The image to fit.
+        screen_size (tuple): The (width, height) of the screen.
+    """
+    if image.get_size() == screen_size:
+        return image
 
-    configData = ConfigRepository('config.json', logging, monitor)
-    
-    mediaRepsitory = MediaRepository(configData)
- 
-    startup_checks(configData)
+    x, y, width, height = fit_box(image.get_size(), screen_size)
 
-    # Initialize Pygame
-    pygame.init()
+    fitted = pygame.Surface(screen_size)
+    fitted.blit(pygame.transform.smoothscale(image, (width, height)), (x, y))
 
-    # Get the display dimensions
-    infoObject = pygame.display.Info()
+    return fitted
 
-    # Set the display dimensions to the screen resolution
-    screen = pygame.display.set_mode((infoObject.current_w, infoObject.current_h), pygame.FULLSCREEN)
 
-    if not args.no_update_ledger and test_internet():
-        update_ledger(mediaRepsitory, configData)
+def run_slideshow(screen, configData, mediaRepository, governor, logger, args, display=0, on_pass_end=None):
+    """
+    Show the ledger on a screen, forever, in a fresh random order on every pass.
 
-    ledger_local = mediaRepsitory.local_ledger['data'].copy()
+    Args:
+        screen (pygame.Surface): The screen to draw onto.
+        display (int): Index of the display, selects the rendition cache.
+        on_pass_end (callable): Called after every pass, before reshuffling.
+    """
+    ledger_local = mediaRepository.local_ledger['data'].copy()
     random.shuffle(ledger_local)
 
     if args.log_analytics:
-        logging.info(f"[Analytics] Shuffling {len(ledger_local)} items")
+        logger.info(f"[Analytics] Shuffling {len(ledger_local)} items")
+
+    screen_width, screen_height = screen.get_width(), screen.get_height()
 
     image = None
     previous_image = None
+    clock = pygame.time.Clock()
+    failed_loads = 0
 
     while True:
        
         count_items = 0
+        shown_items = 0
         tshow = time.time()
 
         while ledger_local:
 
             if args.log_analytics:
-                cpu_temp = get_cpu_temperature()
-                logging.info(f"[Analytics] CPU temperature: {cpu_temp:.2f}°C")
+                cpu_temp = governor.get_temperature()
+                logger.info(f"[Analytics] CPU temperature: {cpu_temp:.2f}°C | Thermal level: {governor.get_level()}")
 
             curr_element = ledger_local.pop(0)
             count_items += 1
 
-            curr_filename = os.path.join(configData.get_cache_path(), curr_element['filename'])
+            curr_filename = mediaRepository.get_rendition_path(curr_element['filename'], display)
+
+            # Pan and zoom over the oversized rendition, when there is one
+            ken_burns_filename = mediaRepository.get_ken_burns_path(curr_element['filename'], display)
+            if ken_burns_filename is not None:
+                curr_filename = ken_burns_filename
             
             # Load the image
             if args.log_analytics:
                 ts_load = time.time()
+
+            try:
+                loaded_image = pygame.image.load(curr_filename)
+            except (pygame.error, FileNotFoundError) as e:
+                # e.g. pruned, or swapped by a cache re-render while shuffled
+                logger.error(f"Could not load {curr_filename}: {e}")
+                failed_loads += 1
+
+                # Nothing loads, e.g. an empty or deleted cache: do not spin on the CPU
+                if failed_loads % MAX_FAILED_LOADS == 0:
+                    logger.warning(f"{failed_loads} consecutive renditions failed to load. Waiting {configData.config['time_show']}s")
+                    time.sleep(configData.config['time_show'])
+                continue
+
+            failed_loads = 0
+            shown_items += 1
             
             if image:
                 previous_image = image
 
-            image = pygame.image.load(curr_filename)
+            # Pan and zoom during the dwell, the transition blends into its first frame
+            effect = None
+            if ken_burns_filename is not None:
+                dwell_fps = governor.dwell_fps()
+                effect = KenBurnsEffect(loaded_image, (screen_width, screen_height), configData.config['time_show'], dwell_fps,
+                                        configData.config['ken_burns_scale_budget'])
+                frame_index = 0
+                image = effect.frame(frame_index)
+            else:
+                image = fit_to_screen(loaded_image, (screen_width, screen_height))
 
             if args.log_analytics:
                 te_load = time.time() - ts_load
 
             # Transition
             if image and previous_image:
+                transition_fps = governor.transition_fps()
                 start_time = time.time()
                 while time.time() - start_time < 2:  # Blend for 2 seconds
                     current_time = time.time() - start_time
                     progress = current_time / 2
         
                     blend_images(screen, previous_image, image, progress)
-                    clock.tick(20)  # Limit updates to 20 times per second
+                    clock.tick(transition_fps)  # Limit updates, throttled when the CPU runs hot
                 
             # Draw the image    
             if args.log_analytics:
@@ -295,27 +324,51 @@ if __name__ == '__main__':
             progress_bar_height = 5
             progress_bar_color = (128, 128, 128) 
             progress_bar_x = 0
-            progress_bar_y = infoObject.current_h - progress_bar_height
-            progress_bar_width = infoObject.current_w
+            progress_bar_y = screen_height - progress_bar_height
+            progress_bar_width = screen_width
  
             clock = pygame.time.Clock()
             start_time = time.time()
+            last_bar_update = 0
             while time.time() - start_time < configData.config['time_show']:
                 current_time = time.time() - start_time
                 progress = 1 - (current_time / configData.config['time_show'])
-                progress_bar_width = int(infoObject.current_w * progress)
+                progress_bar_width = int(screen_width * progress)
+
+                # Redraw the image only when the crop moves, a slow pan keeps it in place for several frames
+                redraw = False
+                if effect is not None:
+                    index = effect.frame_index(1 - progress)
+                    if effect.changed(index, frame_index):
+                        image = effect.frame(index)
+                        screen.blit(image, (0, 0))
+                        redraw = True
+                    frame_index = index
+
+                # The progress bar still moves once per second, unless the image under it was redrawn
+                if effect is not None and not redraw and time.time() - last_bar_update < 1:
+                    clock.tick(dwell_fps)
+                    continue
+                last_bar_update = time.time()
  
                  # Draw progress bar
-                pygame.draw.rect(screen, (0, 0, 0), (0, progress_bar_y, infoObject.current_w, progress_bar_height))  # Clear progress bar area
+                pygame.draw.rect(screen, (0, 0, 0), (0, progress_bar_y, screen_width, progress_bar_height))  # Clear progress bar area
                 pygame.draw.rect(screen, progress_bar_color, (progress_bar_x, progress_bar_y, progress_bar_width, progress_bar_height))
     
                 # Update the display
-                pygame.display.update((0, progress_bar_y, progress_bar_width, progress_bar_height))
-                clock.tick(1)  # Limit updates to 1 times per second
+                if redraw:
+                    pygame.display.update()
+                else:
+                    pygame.display.update((0, progress_bar_y, progress_bar_width, progress_bar_height))
+
+                if effect is not None:
+                    clock.tick(dwell_fps)  # Limit updates to the pan and zoom frame rate
+                else:
+                    clock.tick(1)  # Limit updates to 1 times per second
 
             if args.log_analytics:
                 te_show = time.time() - ts_show
-                logging.info(f"[Analytics] Showing {curr_element['filename']} | Load time: {te_load:.5f}s | Draw time: {te_draw:.5f}s | Shown for {te_show:.5f}s")
+                logger.info(f"[Analytics] Showing {curr_element['filename']} | Load time: {te_load:.5f}s | Draw time: {te_draw:.5f}s | Shown for {te_show:.5f}s")
                 
             for event in pygame.event.get():
                 if event.type == pygame.KEYDOWN:
@@ -324,16 +377,187 @@ if __name__ == '__main__':
                     exit()
        
         if args.log_analytics:
-            logging.info(f"[Analytics] Showed {count_items} items")
+            logger.info(f"[Analytics] Showed {count_items} items")
 
-        if not args.no_update_ledger and test_internet():
-            update_ledger( mediaRepsitory, configData)
+        # Empty ledger, or fewer failures than MAX_FAILED_LOADS: still wait before the next pass
+        if shown_items == 0:
+            time.sleep(configData.config['time_show'])
+
+        if on_pass_end is not None:
+            on_pass_end()
         
-        ledger_local = mediaRepsitory.local_ledger['data'].copy()
+        ledger_local = mediaRepository.local_ledger['data'].copy()
         random.shuffle(ledger_local)
 
         if args.log_analytics:
-            logging.info(f"[Analytics] Shuffling {len(ledger_local)} items")
+            logger.info(f"[Analytics] Shuffling {len(ledger_local)} items")
 
         # Check if there is an update in the config file
         configData.update_config_if_changed()
+
+
+def get_sdl_display_index(displays, display):
+    """
+    Map a display, as listed by screeninfo, to the index SDL gives it. Displays are
+    matched by resolution, in order. Displays of the same resolution share their
+    cache, so which one of them shows which playlist does not matter.
+
+    Returns:
+        int: The SDL display index, None if SDL has no display left of that resolution.
+    """
+    available = list(enumerate(pygame.display.get_desktop_sizes()))
+
+    for idx, _display in enumerate(displays):
+        size = (_display['width'], _display['height'])
+        match = next((sdl_index for sdl_index, sdl_size in available if tuple(sdl_size) == size), None)
+
+        if idx == display:
+            return match
+
+        available = [(sdl_index, sdl_size) for sdl_index, sdl_size in available if sdl_index != match]
+
+    return None
+
+
+def display_process(display, args, thermal_state):
+    """
+    Entry point of the process driving one display in multi-display mode.
+
+    Every display has its own playlist and renders independently. Ingest and
+    thermal sampling only happen in the main process; the ledger is re-read from
+    disk after every pass and the thermal level is read from `thermal_state`.
+
+    Every process opens a fullscreen window on its SDL display. This needs a
+    display server: the x11 and wayland video drivers are supported. With
+    kmsdrm, a single process can drive the display device, so only one display
+    can be used.
+    """
+    logger = get_logger(f'MemoryLane.display{display}', f'/tmp/MemoryLane_display{display}.log')
+
+    # Exit through sys.exit on SIGTERM, so atexit flushes the log writer
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    logger.info(f"Starting display {display}")
+
+    configData = ConfigRepository('config.json', logger)
+    mediaRepository = MediaRepository(configData)
+
+    _display = configData.get_displays()[display]
+
+    governor = ThermalGovernor(configData, logger, thermal_state)
+
+    # The fullscreen windows of the other displays take the focus, keep this one shown anyway
+    os.environ['SDL_VIDEO_MINIMIZE_ON_FOCUS_LOSS'] = '0'
+    pygame.init()
+    pygame.mouse.set_visible(False)
+
+    driver = pygame.display.get_driver()
+    if driver not in MULTI_DISPLAY_VIDEO_DRIVERS:
+        logger.warning(f"Video driver {driver} is not supported with multi_display, use one of {MULTI_DISPLAY_VIDEO_DRIVERS}")
+
+    sdl_display = get_sdl_display_index(configData.get_displays(), display)
+    if sdl_display is None:
+        logger.critical(f"No display of {_display['width']}x{_display['height']} found by SDL ({pygame.display.get_desktop_sizes()}). Terminating display {display}")
+        sys.exit(EXIT_ERROR)
+
+    screen = pygame.display.set_mode((_display['width'], _display['height']), pygame.FULLSCREEN, display=sdl_display)
+
+    run_slideshow(screen, configData, mediaRepository, governor, logger, args, display=display, 
+                  on_pass_end=mediaRepository.load_local_ledger)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Memory Lane')
+    parser.add_argument('--no-update-ledger', action='store_true', help='Do not update ledger from cloud')
+    parser.add_argument('--log-analytics', action='store_true', help='Log analytics data')
+    parser.add_argument('--find-duplicates', action='store_true', help='Cluster near-duplicates in the whole library, write a report and exit')
+    parser.add_argument('--prune-duplicates', action='store_true', help='With --find-duplicates, remove the extra copies from the ledger and cache')
+    parser.add_argument('--duplicates-report', default='duplicates_report.json', help='Path of the near-duplicates report')
+    parser.add_argument('--duplicates-distance', type=int, default=9, help='Maximum Hamming distance between near-duplicates')
+    parser.add_argument('--sync', choices=['push', 'pull'], help='Delta-sync the whole library with sftp_path and exit')
+    parser.add_argument('--rerender-cache', action='store_true', help='Re-render the cache for the current resolution and JPEG quality and exit')
+    args = parser.parse_args()
+
+    logging = get_logger('MemoryLane', '/tmp/MemoryLane.log')
+
+    logging.info(f"Starting! Running version {VERSION}")
+
+    check_execution_paths()
+
+    monitor = Monitor()
+    monitor.initialize()
+
+    configData = ConfigRepository('config.json', logging, monitor)
+    
+    mediaRepsitory = MediaRepository(configData)
+ 
+    startup_checks(configData)
+
+    if args.find_duplicates:
+        clusterer = DuplicateClusterer(mediaRepsitory, configData, logging, max_distance=args.duplicates_distance)
+        clusterer.run(args.duplicates_report, prune=args.prune_duplicates)
+        sys.exit(0)
+
+    if args.sync:
+        librarySync = LibrarySync(mediaRepsitory, configData, logging)
+        sys.exit(0 if librarySync.run(args.sync) else EXIT_ERROR)
+
+    if args.rerender_cache:
+        cacheRenderer = CacheRenderer(mediaRepsitory, configData, logging)
+        sys.exit(0 if cacheRenderer.run() else EXIT_ERROR)
+
+    # Shared with the display processes, only this process samples the temperature
+    context = multiprocessing.get_context('spawn')
+    thermal_state = context.Array('d', [0, 0.0])
+
+    governor = ThermalGovernor(configData, logging, thermal_state)
+    sampler = ThermalSampler(configData.config['thermal_sample_period'], governor.update)
+    sampler.start()
+
+    def ingest():
+        if not args.no_update_ledger and test_internet():
+            update_ledger(mediaRepsitory, configData, governor)
+
+    ingest()
+
+    displays = configData.get_displays()
+
+    if len(displays) > 1:
+        # One process per display, the renditions for all of them are prepared once by ingest()
+        processes = [context.Process(target=display_process, args=(display, args, thermal_state), daemon=True) for display in range(len(displays))]
+        for process in processes:
+            process.start()
+
+        logging.info(f"Driving {len(displays)} displays")
+
+        # Keep ingesting until any display exits (e.g. a key was pressed), then stop them all
+        while not wait([process.sentinel for process in processes], timeout=configData.config['ingest_interval']):
+            ingest()
+            configData.update_config_if_changed()
+
+        # SIGTERM lets the display processes flush their logs before exiting
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.kill()
+
+        sys.exit(0)
+
+    # Initialize Pygame
+    pygame.init()
+
+    # Get the display dimensions
+    infoObject = pygame.display.Info()
+
+    # Set the display dimensions to the screen resolution
+    screen = pygame.display.set_mode((infoObject.current_w, infoObject.current_h), pygame.FULLSCREEN)
+
+    def end_of_pass():
+        ingest()
+        # Pick up the changes saved by the maintenance commands, e.g. pruned duplicates
+        mediaRepsitory.load_local_ledger()
+
+    run_slideshow(screen, configData, mediaRepsitory, governor, logging, args, on_pass_end=end_of_pass)
@@ -0,0 +1,278 @@
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from tqdm import tqdm
+
+from config_engine import parse_cache_size
+from media_repository import SFTPClient, file_checksum, get_content_size, render_rendition
+
+MANIFEST_FILENAME = 'manifest.json'
+MANIFEST_VERSION = 1
+
+class LibrarySync:
+    """
+    Delta sync between the local ledger and cache and the remote library at `sftp_path`.
+
+    The remote library holds one directory per rendition resolution, named like the
+    local caches, and a manifest with the ledger entries and the checksum of every
+    rendition. Only the renditions missing or with a different checksum are
+    transferred. Transfers land in a `.part` file that is renamed once complete,
+    and the manifest (push) or ledger (pull) is checkpointed regularly, so an
+    interrupted sync resumes where it stopped.
+    """
+    def __init__(self, media_repository, config_data, logger, workers=None, checkpoint_every=20):
+        self.media_repository = media_repository
+        self.config_data = config_data
+        self.logger = logger
+        self.workers = workers or config_data.config['sync_workers']
+        self.checkpoint_every = checkpoint_every
+        self.remote_root = config_data.config['sftp_path']
+
+        # One SFTP connection per worker thread
+        self.thread_local = threading.local()
+        self.clients = []
+        self.clients_lock = threading.Lock()
+
+    def get_client(self):
+        client = getattr(self.thread_local, 'client', None)
+        if client is None or not client.is_connected():
+            client = SFTPClient(self.config_data.config['sftp_address'],
+                                self.config_data.config['sftp_user'],
+                                self.config_data.config['sftp_password'])
+            client.connect()
+            self.thread_local.client = client
+            with self.clients_lock:
+                self.clients.append(client)
+        return client
+
+    def close(self):
+        with self.clients_lock:
+            for client in self.clients:
+                client.close()
+            self.clients = []
+
+    def remote_path(self, *parts):
+        return os.path.join(self.remote_root, *parts)
+
+    def cache_name(self, size):
+        return os.path.basename(self.config_data.get_cache_path_for_size(*size))
+
+    def local_path(self, size, filename):
+        return os.path.join(self.config_data.get_cache_path_for_size(*size), filename)
+
+    def local_checksum(self, filename, size):
+        """
+        Checksum of a local rendition, None if missing. Always computed from the file:
+        the checksum in the ledger can be stale, and pushed to the manifest it would
+        fail every pull of the rendition.
+        """
+        path = self.local_path(size, filename)
+        if not os.path.isfile(path):
+            return None
+
+        return file_checksum(path)
+
+    def load_remote_manifest(self):
+        client = self.get_client()
+        path = self.remote_path(MANIFEST_FILENAME)
+
+        if not client.file_exists(path):
+            self.logger.info(f'No manifest found at {path}. Remote library is empty')
+            return {'info': {'version': MANIFEST_VERSION}, 'data': [], 'renditions': {}}
+
+        return json.loads(client.download_file_bytes(path))
+
+    def save_remote_manifest(self, manifest):
+        client = self.get_client()
+        path = self.remote_path(MANIFEST_FILENAME)
+
+        client.upload_bytes(json.dumps(manifest, indent=4).encode('utf-8'), path + '.part')
+        client.rename(path + '.part', path)
+
+    def run_transfers(self, tasks, transfer, on_done, checkpoint):
+        """
+        Run the transfers on the worker threads. `on_done` and `checkpoint` are
+        called from the calling thread only.
+
+        :return: The number of failed transfers.
+        """
+        failed = 0
+        completed = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(transfer, task): task for task in tasks}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                task = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    self.logger.error(f"Error transferring {task['filename']}: {e}")
+                    failed += 1
+                    continue
+
+                on_done(task)
+                completed += 1
+                if completed % self.checkpoint_every == 0:
+                    checkpoint()
+
+        checkpoint()
+        return failed
+
+    ## Push: local -> remote
+    def upload_rendition(self, task):
+        client = self.get_client()
+        remote_path = self.remote_path(task['cache_name'], task['filename'])
+
+        client.upload_file(self.local_path(task['size'], task['filename']), remote_path + '.part')
+        client.rename(remote_path + '.part', remote_path)
+
+    def push(self):
+        manifest = self.load_remote_manifest()
+        renditions = manifest.setdefault('renditions', {})
+        entries = self.media_repository.local_ledger['data']
+
+        client = self.get_client()
+        client.make_dir(self.remote_root)
+
+        tasks = []
+        for size in self.config_data.get_rendition_sizes():
+            cache_name = self.cache_name(size)
+            remote_checksums = renditions.setdefault(cache_name, {})
+            client.make_dir(self.remote_path(cache_name))
+
+            for entry in entries:
+                checksum = self.local_checksum(entry['filename'], size)
+                if checksum is None:
+                    self.logger.warning(f"{entry['filename']} not found in {self.config_data.get_cache_path_for_size(*size)}")
+                    continue
+                if remote_checksums.get(entry['filename']) != checksum:
+                    tasks.append({'filename': entry['filename'], 'size': size, 'cache_name': cache_name, 'checksum': checksum})
+
+        # Local entries win over the remote ones with the same filename
+        remote_entries = {entry['filename']: entry for entry in manifest['data']}
+        remote_entries.update({entry['filename']: entry for entry in entries})
+        manifest['data'] = list(remote_entries.values())
+
+        self.logger.info(f'Pushing {len(tasks)} renditions to {self.remote_root}')
+
+        def on_done(task):
+            renditions[task['cache_name']][task['filename']] = task['checksum']
+
+        failed = self.run_transfers(tasks, self.upload_rendition, on_done, lambda: self.save_remote_manifest(manifest))
+
+        self.logger.info(f'Push finished. {len(tasks) - failed} renditions transferred, {failed} failed')
+        return failed == 0
+
+    ## Pull: remote -> local
+    def download_rendition(self, task):
+        client = self.get_client()
+        local_path = self.local_path(task['size'], task['filename'])
+
+        client.download_file(self.remote_path(task['cache_name'], task['filename']),
+                             os.path.dirname(local_path), task['filename'] + '.part')
+
+        if file_checksum(local_path + '.part') != task['checksum']:
+            os.remove(local_path + '.part')
+            raise ValueError('checksum mismatch')
+
+        os.replace(local_path + '.part', local_path)
+
+    def render_rendition(self, task):
+        """No rendition at this resolution remotely: render it from the largest one available."""
+        client = self.get_client()
+        local_path = self.local_path(task['size'], task['filename'])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            client.download_file(self.remote_path(task['source_cache_name'], task['filename']), tmp_dir, task['filename'])
+            task['checksum'] = render_rendition(os.path.join(tmp_dir, task['filename']), local_path,
+                                                task['size'], self.config_data.config['jpeg_quality'],
+                                                get_content_size(task['entry']))
+
+    def best_remote_source(self, filename, renditions):
+        candidates = [cache_name for cache_name, checksums in renditions.items() if filename in checksums]
+        if not candidates:
+            return None
+
+        return max(candidates, key=lambda cache_name: parse_cache_size(cache_name)[0] * parse_cache_size(cache_name)[1])
+
+    def pull(self):
+        manifest = self.load_remote_manifest()
+        renditions = manifest.get('renditions', {})
+        local_entries = {entry['filename']: entry for entry in self.media_repository.local_ledger['data']}
+        primary_size = self.config_data.get_monitor_size()
+        monitor_sizes = self.config_data.get_monitor_sizes()
+
+        tasks = []
+        for size in self.config_data.get_rendition_sizes():
+            cache_name = self.cache_name(size)
+
+            for entry in manifest['data']:
+                filename = entry['filename']
+                remote_checksum = renditions.get(cache_name, {}).get(filename)
+                local_checksum = self.local_checksum(filename, size)
+
+                task = {'filename': filename, 'size': size, 'cache_name': cache_name, 'entry': entry}
+
+                if remote_checksum is not None and local_checksum != remote_checksum:
+                    # Matching rendition remotely: plain download, no decode nor resize
+                    task['checksum'] = remote_checksum
+                    tasks.append(task)
+                elif local_checksum is None:
+                    task['source_cache_name'] = self.best_remote_source(filename, renditions)
+                    if task['source_cache_name'] is None:
+                        self.logger.warning(f'{filename} has no rendition in {self.remote_root}')
+                        continue
+                    # An oversized Ken Burns rendition is not upscaled from a smaller one, the item is shown without the effect
+                    source_size = parse_cache_size(task['source_cache_name'])
+                    if size not in monitor_sizes and (source_size[0] < size[0] or source_size[1] < size[1]):
+                        continue
+                    tasks.append(task)
+                elif filename not in local_entries and size == primary_size:
+                    # Already in the cache, e.g. transferred before an interruption, but not yet in the ledger
+                    task['checksum'] = local_checksum
+                    task['source_cache_name'] = None
+                    tasks.append(task)
+
+        self.logger.info(f'Pulling {len(tasks)} renditions from {self.remote_root}')
+
+        def transfer(task):
+            if 'source_cache_name' not in task:
+                self.download_rendition(task)
+            elif task['source_cache_name'] is not None:
+                self.render_rendition(task)
+
+        # Merged into the ledger on disk at every checkpoint, the frame may ingest new items in the meantime
+        pulled = {}
+
+        def on_done(task):
+            # The ledger only references an entry once its primary rendition is in place
+            if task['size'] != primary_size:
+                return
+
+            entry = dict(task['entry'])
+            entry['checksum'] = task['checksum']
+            pulled[task['filename']] = entry
+
+        def merge_pulled(entries):
+            known_entries = {entry['filename']: entry for entry in entries}
+            for filename, entry in pulled.items():
+                if filename in known_entries:
+                    known_entries[filename].update(entry)
+                else:
+                    entries.append(entry)
+            pulled.clear()
+
+        failed = self.run_transfers(tasks, transfer, on_done, lambda: self.media_repository.update_local_ledger(merge_pulled))
+
+        self.logger.info(f'Pull finished. {len(tasks) - failed} renditions transferred, {failed} failed')
+        return failed == 0
+
+    def run(self, direction):
+        try:
+            if direction == 'push':
+                return self.push()
+            return self.pull()
+        finally:
+            self.close()
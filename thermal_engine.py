@@ -0,0 +1,147 @@
+import os
+import platform
+import threading
+
+THERMAL_LEVEL_NORMAL = 0
+THERMAL_LEVEL_WARM = 1
+THERMAL_LEVEL_HOT = 2
+
+THERMAL_LEVEL_NAMES = {
+    THERMAL_LEVEL_NORMAL: 'normal',
+    THERMAL_LEVEL_WARM: 'warm',
+    THERMAL_LEVEL_HOT: 'hot'
+}
+
+def get_cpu_temperature():
+    """
+    Returns the current CPU temperature in degrees Celsius.
+    If the machine is not running Linux, returns 0.
+    """
+    # Check if the machine is running Linux
+    if platform.system() != 'Linux':
+        return 0
+
+    # Check if the temperature file exists
+    temp_file = '/sys/class/thermal/thermal_zone0/temp'
+    if not os.path.exists(temp_file):
+        return 0
+
+    # Read the temperature from the sysfs file
+    with open(temp_file, 'r') as f:
+        temp = f.read().strip()
+
+    # Convert the temperature from millidegrees Celsius to degrees Celsius
+    temp = int(temp) / 1000
+
+    return temp
+
+class ThermalSampler:
+    """
+    Reads the CPU temperature from a background thread, so the display loop
+    never touches sysfs. The latest reading is forwarded to an optional callback.
+    """
+    def __init__(self, period, callback=None):
+        self.period = period
+        self.callback = callback
+        self.temperature = get_cpu_temperature()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+
+        self.thread = threading.Thread(target=self.run, name='ThermalSampler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.temperature = get_cpu_temperature()
+            except (OSError, ValueError):
+                # Keep the last good reading if sysfs hiccups
+                pass
+
+            if self.callback is not None:
+                self.callback(self.temperature)
+
+            self.stop_event.wait(self.period)
+
+    def get_temperature(self):
+        return self.temperature
+
+class ThermalGovernor:
+    """
+    Scales down the transition and pan and zoom fps, the ingest worker count and
+    the hashing batch size as the CPU heats up, and restores them once it cools down.
+    """
+    def __init__(self, config_data, logger, shared_state=None):
+        """
+        :param shared_state: Optional multiprocessing Array('d', 2) holding the thermal
+            level and the last temperature, so the display processes follow the
+            readings of the main process instead of sampling on their own.
+        """
+        self.config_data = config_data
+        self.logger = logger
+        self.state = shared_state if shared_state is not None else [THERMAL_LEVEL_NORMAL, 0.0]
+        self.lock = threading.Lock()
+
+    def update(self, temperature):
+        """
+        Recompute the thermal level from a temperature reading.
+
+        The level goes up as soon as a threshold is reached, but only goes down
+        once the temperature is `thermal_hysteresis` degrees below it, so the
+        governor does not oscillate around a threshold.
+
+        :param temperature: CPU temperature in degrees Celsius.
+        :return: The new thermal level.
+        """
+        config = self.config_data.config
+        thresholds = [config['thermal_warm_threshold'], config['thermal_hot_threshold']]
+        hysteresis = config['thermal_hysteresis']
+
+        with self.lock:
+            current_level = self.get_level()
+            level = current_level
+
+            while level < THERMAL_LEVEL_HOT and temperature >= thresholds[level]:
+                level += 1
+
+            while level > THERMAL_LEVEL_NORMAL and temperature < thresholds[level - 1] - hysteresis:
+                level -= 1
+
+            if level != current_level:
+                self.logger.warning(f"CPU temperature {temperature:.2f}°C. Thermal level changed from {THERMAL_LEVEL_NAMES[current_level]} to {THERMAL_LEVEL_NAMES[level]}")
+
+            self.state[0], self.state[1] = level, temperature
+
+        return level
+
+    def get_level(self):
+        return int(self.state[0])
+
+    def get_temperature(self):
+        return self.state[1]
+
+    def throttle(self, value):
+        """Halve a value for every thermal level above normal, never going below 1."""
+        return max(1, int(value) >> self.get_level())
+
+    def transition_fps(self):
+        return self.throttle(self.config_data.config['transition_fps'])
+
+    def dwell_fps(self):
+        return self.throttle(self.config_data.config['ken_burns_fps'])
+
+    def ingest_workers(self):
+        return self.throttle(self.config_data.config['ingest_workers'])
+
+    def hash_batch_size(self):
+        return self.throttle(self.config_data.config['hash_batch_size'])